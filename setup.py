@@ -73,6 +73,7 @@ setup(
     include_package_data=True,
     packages=find_packages(),
     install_requires=required,
+    extras_require={"numba": ["numba"]},
     cmdclass={
         "upload": UploadCommand,
     },
@@ -1,4 +1,13 @@
-from .filter import Bandpass, Composition, Downsample, Notch, get_default_transform
+from .filter import (
+    Bandpass,
+    Composition,
+    Downsample,
+    Notch,
+    NotchBandpass,
+    NotchBandpassDecimate,
+    NumbaSOS,
+    get_default_transform,
+)
 from .thu import THU_RSVP_Dataset
 
 __version__ = "1.1.0"
@@ -8,6 +17,9 @@ __all__ = [
     "Composition",
     "Downsample",
     "Notch",
+    "NotchBandpass",
+    "NotchBandpassDecimate",
+    "NumbaSOS",
     "get_default_transform",
     "THU_RSVP_Dataset",
 ]
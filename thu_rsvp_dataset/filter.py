@@ -1,8 +1,31 @@
 """Signal processing, adapted from BciPy (see https://github.com/CAMBI-tech/BciPy)"""
+from functools import lru_cache
 from typing import Optional, Tuple
 
 import numpy as np
-from scipy.signal import butter, filtfilt, iirnotch, sosfilt
+from scipy.signal import butter, iirnotch, sosfilt, sosfilt_zi, tf2sos
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional, only needed for NumbaSOS
+    njit = None
+
+
+# Filter designs are cached so that constructing the same filter repeatedly does no redesign work.
+# Callers copy the (small) cached arrays, so that instances do not share mutable state.
+@lru_cache(maxsize=None)
+def _design_notch(sample_rate_hz, remove_freq_hz, quality_factor) -> Tuple[np.ndarray, np.ndarray]:
+    """Notch filter as float32 SOS, along with its `sosfilt_zi` initial conditions"""
+    sos = tf2sos(*iirnotch(remove_freq_hz / (sample_rate_hz / 2), quality_factor)).astype(np.float32)
+    zi = sosfilt_zi(sos).astype(np.float32)
+    return sos, zi
+
+
+@lru_cache(maxsize=None)
+def _design_butter(lo, hi, sample_rate_hz, order) -> np.ndarray:
+    """Butterworth bandpass filter as float32 SOS"""
+    nyq = 0.5 * sample_rate_hz
+    return butter(order, [lo / nyq, hi / nyq], analog=False, btype="band", output="sos").astype(np.float32)
 
 
 class Composition:
@@ -11,6 +34,16 @@ class Composition:
     def __init__(self, *transforms):
         self.transforms = transforms
 
+    @property
+    def per_channel(self) -> bool:
+        """Whether all transforms act on each channel independently, so unused channels can be dropped afterwards"""
+        return all(getattr(t, "per_channel", False) for t in self.transforms)
+
+    @property
+    def supports_batching(self) -> bool:
+        """Whether all transforms act causally along the last axis, so zero-padded blocks can be stacked"""
+        return all(getattr(t, "supports_batching", False) for t in self.transforms)
+
     def __call__(self, data: np.ndarray, fs: Optional[int] = None) -> Tuple[np.ndarray, int]:
         for transform in self.transforms:
             data, fs = transform(data, fs)
@@ -18,7 +51,7 @@ class Composition:
 
     def _get_downsample_factor(self):
         for t in self.transforms:
-            if isinstance(t, Downsample):
+            if isinstance(t, (Downsample, NotchBandpassDecimate, NumbaSOS)):
                 return t.factor
         raise ValueError("No downsample transform found")
 
@@ -26,39 +59,144 @@ class Composition:
 class Downsample:
     """Downsampling by an integer factor"""
 
+    per_channel = True
+    supports_batching = True
+
     def __init__(self, factor: int = 2):
         self.factor = factor
 
     def __call__(self, data: np.ndarray, fs: Optional[int] = None) -> Tuple[np.ndarray, int]:
         if fs:
-            return data[:, :: self.factor], fs // self.factor
+            return data[..., :: self.factor], fs // self.factor
         else:
-            return data[:, :: self.factor], None
+            return data[..., :: self.factor], None
 
 
 class Notch:
     """Remove a single frequency"""
 
+    per_channel = True
+
     def __init__(self, sample_rate_hz, remove_freq_hz=60.0, quality_factor=30):
-        remove_freq_hz = remove_freq_hz / (sample_rate_hz / 2)
-        self.b, self.a = iirnotch(remove_freq_hz, quality_factor)
+        # zi holds steady-state initial conditions for a unit step, scaled by the first sample of each channel
+        self.sos, self.zi = (x.copy() for x in _design_notch(sample_rate_hz, remove_freq_hz, quality_factor))
+        # Same default padding as `sosfiltfilt`
+        self.padlen = 3 * (2 * len(self.sos) + 1 - min((self.sos[:, 2] == 0).sum(), (self.sos[:, 5] == 0).sum()))
 
     def __call__(self, data: np.ndarray, fs: Optional[int] = None) -> Tuple[np.ndarray, int]:
-        return filtfilt(self.b, self.a, data), fs
+        """Zero-phase forward-backward filtering, equivalent to `sosfiltfilt` but reusing the precomputed `zi`"""
+        n = self.padlen
+        if data.shape[-1] <= n:
+            raise ValueError(f"The length of the input vector must be greater than padlen, which is {n}.")
+        ext = np.concatenate(
+            [2 * data[..., :1] - data[..., n:0:-1], data, 2 * data[..., -1:] - data[..., -2 : -n - 2 : -1]], axis=-1
+        )
+        zi = self.zi.reshape((len(self.sos),) + (1,) * (data.ndim - 1) + (2,))
+        y, _ = sosfilt(self.sos, ext, axis=-1, zi=zi * ext[..., :1])
+        y = y[..., ::-1]
+        y, _ = sosfilt(self.sos, y, axis=-1, zi=zi * y[..., :1])
+        return np.ascontiguousarray(y[..., ::-1][..., n:-n]), fs
 
 
 class Bandpass:
     """Preserve a specified range of frequencies"""
 
+    per_channel = True
+    supports_batching = True
+
     def __init__(self, lo, hi, sample_rate_hz, order=5):
-        nyq = 0.5 * sample_rate_hz
-        lo, hi = lo / nyq, hi / nyq
-        self.sos = butter(order, [lo, hi], analog=False, btype="band", output="sos")
+        # Coefficients are float32 so that filtering float32 data does not upcast to float64
+        self.sos = _design_butter(lo, hi, sample_rate_hz, order).copy()
 
     def __call__(self, data: np.ndarray, fs: Optional[int] = None) -> Tuple[np.ndarray, int]:
         return sosfilt(self.sos, data), fs
 
 
+class NotchBandpass:
+    """Remove a single frequency and preserve a specified range of frequencies, in a single filter pass"""
+
+    per_channel = True
+    supports_batching = True
+
+    def __init__(self, lo, hi, sample_rate_hz, order=5, remove_freq_hz=60.0, quality_factor=30):
+        sos_notch, _ = _design_notch(sample_rate_hz, remove_freq_hz, quality_factor)
+        sos_bandpass = _design_butter(lo, hi, sample_rate_hz, order)
+        self.sos = np.vstack([sos_notch, sos_bandpass])
+
+    def __call__(self, data: np.ndarray, fs: Optional[int] = None) -> Tuple[np.ndarray, int]:
+        return sosfilt(self.sos, data, axis=-1), fs
+
+
+class NotchBandpassDecimate(NotchBandpass):
+    """Remove a single frequency, preserve a specified range of frequencies, and downsample by an integer factor"""
+
+    def __init__(self, lo, hi, sample_rate_hz, order=5, remove_freq_hz=60.0, quality_factor=30, factor: int = 2):
+        super().__init__(lo, hi, sample_rate_hz, order, remove_freq_hz, quality_factor)
+        self.factor = factor
+
+    def __call__(self, data: np.ndarray, fs: Optional[int] = None) -> Tuple[np.ndarray, int]:
+        # The IIR filter must run at the original rate; decimation is a strided view like `Downsample`
+        data, _ = super().__call__(data)
+        data = data[..., :: self.factor]
+        if fs:
+            return data, fs // self.factor
+        else:
+            return data, None
+
+
+class NumbaSOS:
+    """
+    Apply a cascade of second-order sections (e.g. `NotchBandpass(...).sos`) using a numba-compiled loop,
+    and optionally downsample by an integer factor in the same pass. Requires numba.
+    """
+
+    per_channel = True
+    supports_batching = True
+
+    def __init__(self, sos: np.ndarray, factor: int = 1):
+        if njit is None:
+            raise ImportError("NumbaSOS requires numba, install with `pip install thu-rsvp-dataset[numba]`")
+        sos = np.atleast_2d(sos)
+        if sos.ndim != 2 or sos.shape[1] != 6:
+            raise ValueError(f"sos array must be of shape (n_sections, 6), got {sos.shape}")
+        if not np.all(sos[:, 3] == 1):
+            raise ValueError("sos[:, 3] should be all ones")
+        self.sos = np.ascontiguousarray(sos, dtype=np.float32)
+        self.factor = factor
+
+    def __call__(self, data: np.ndarray, fs: Optional[int] = None) -> Tuple[np.ndarray, int]:
+        data = np.ascontiguousarray(data, dtype=np.float32)
+        rows = data.reshape(-1, data.shape[-1])
+        out = np.empty((rows.shape[0], -(-rows.shape[-1] // self.factor)), dtype=np.float32)
+        _sosfilt_decimate(self.sos, rows, self.factor, out)
+        out = out.reshape(*data.shape[:-1], out.shape[-1])
+        if fs:
+            return out, fs // self.factor
+        else:
+            return out, None
+
+
+if njit is not None:
+
+    @njit(cache=True, fastmath=True)
+    def _sosfilt_decimate(sos, x, factor, out):
+        # Direct-form II transposed, as in scipy's sosfilt. Each row is filtered from zero initial state,
+        # and only every `factor`-th output sample is stored.
+        n_sections = sos.shape[0]
+        zi = np.empty((n_sections, 2), dtype=x.dtype)
+        for r in range(x.shape[0]):
+            zi[:] = 0
+            for n in range(x.shape[1]):
+                xn = x[r, n]
+                for s in range(n_sections):
+                    yn = sos[s, 0] * xn + zi[s, 0]
+                    zi[s, 0] = sos[s, 1] * xn - sos[s, 4] * yn + zi[s, 1]
+                    zi[s, 1] = sos[s, 2] * xn - sos[s, 5] * yn
+                    xn = yn
+                if n % factor == 0:
+                    out[r, n // factor] = xn
+
+
 def get_default_transform(
     sample_rate_hz: int,
     notch_freq_hz: int,
@@ -67,9 +205,26 @@ def get_default_transform(
     bandpass_high: int,
     bandpass_order: int,
     downsample_factor: int,
+    use_numba: bool = False,
 ) -> Composition:
+    if use_numba:
+        sos = NotchBandpass(
+            bandpass_low,
+            bandpass_high,
+            sample_rate_hz,
+            bandpass_order,
+            remove_freq_hz=notch_freq_hz,
+            quality_factor=notch_quality_factor,
+        ).sos
+        return Composition(NumbaSOS(sos, factor=downsample_factor))
     return Composition(
-        Notch(sample_rate_hz, notch_freq_hz, notch_quality_factor),
-        Bandpass(bandpass_low, bandpass_high, sample_rate_hz, bandpass_order),
-        Downsample(downsample_factor),
+        NotchBandpassDecimate(
+            bandpass_low,
+            bandpass_high,
+            sample_rate_hz,
+            bandpass_order,
+            remove_freq_hz=notch_freq_hz,
+            quality_factor=notch_quality_factor,
+            factor=downsample_factor,
+        ),
     )
@@ -1,9 +1,10 @@
 import multiprocessing
-import subprocess
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from functools import partial
-from multiprocessing import Pool
 from pathlib import Path
 from typing import Callable, Optional, Tuple
+from zipfile import ZipFile
 
 import numpy as np
 from loguru import logger
@@ -15,8 +16,8 @@ from .files import (
     WHICH_FOLDER_EACH_SUBJECT,
     ZIP_FILES_AND_SHA256SUMS,
 )
-from .utils import download_url, file_sha256hash, verify_file
-from .worker import load_trials_one_session
+from .utils import cached_file_sha256hash, chunks, download_url, verify_file
+from .worker import load_trials_sessions
 
 
 class THU_RSVP_Dataset:
@@ -29,6 +30,7 @@ class THU_RSVP_Dataset:
         verify_sha256=True,
         verbose=False,
         force_extract=False,
+        channel_first=False,
     ):
         """
         Wrapper class for loading THU RSVP Dataset.
@@ -40,11 +42,16 @@ class THU_RSVP_Dataset:
             trial_duration_ms (int): desired duration of each trial in milliseconds after stimulus onset
             transform (Optional[Callable]): transform function to apply to each session.
                 Transform must take data and original sample rate, and return transformed data and new sample rate.
+                NOTE - transforms marked `per_channel` (such as the built-in filters) are applied to all 64 channels,
+                and unused channels are dropped afterwards. Other transforms receive only the channels in use.
             download (bool): whether to download original files. Defaults to False.
             verify_sha256 (bool): whether to verify sha256 checksums of downloaded files. Defaults to True.
             verbose (bool): whether to print verbose info. Defaults to False.
             force_extract (bool): if True, ignores previously saved *.npy results and re-extracts.
                 NOTE - Use this to re-process after changing transform functions.
+            channel_first (bool): if True, trial data is stored with shape (n_channels, n_trials, ...) instead of
+                (n_trials, n_channels, ...). Each channel's filtered data is then written contiguously, which makes
+                extraction faster. Use `np.moveaxis(data, 0, 1)` for a (lazy) trial-first view. Defaults to False.
         """
         self.dir = dir / "thu"
         self.trial_duration_ms = trial_duration_ms
@@ -52,19 +59,32 @@ class THU_RSVP_Dataset:
         self.download = download
         self.verbose = verbose
         self.verify_sha256 = verify_sha256
-        self.n_trials = 64 * 2 * 2 * 40 * 100
+        self.n_trials_per_session = 2 * 40 * 100
+        self.n_trials = 64 * 2 * self.n_trials_per_session
         self.original_sample_rate_hz = 250
         # Remove channels with indices 32 and 42, based on guidance in pper
-        self.channels_to_use = np.r_[0:32, 33:42, 43:64]
+        self.n_original_channels = 64
+        self.channel_mask = np.ones(self.n_original_channels, dtype=bool)
+        self.channel_mask[[32, 42]] = False
+        # Integer indices are computed once here, since the trial gather combines them with trial sample indices
+        self.channels_to_use = np.flatnonzero(self.channel_mask)
         self.n_channels = len(self.channels_to_use)
         self.force_extract = force_extract
+        self.channel_first = channel_first
 
         if self.transform is not None:
             # Create dummy data and check what shape transform produces
             dummy_duration = int(self.trial_duration_ms / 1000 * self.original_sample_rate_hz)
-            dummy_data = np.ones((self.n_channels, dummy_duration))
-            dummy_output, self.final_sample_rate_hz = transform(dummy_data, self.original_sample_rate_hz)
-            self.output_shape = dummy_output.shape
+            if getattr(transform, "per_channel", False):
+                dummy_data = np.ones((self.n_original_channels, dummy_duration), dtype=np.float32)
+                dummy_output, self.final_sample_rate_hz = transform(dummy_data, self.original_sample_rate_hz)
+                if dummy_output.shape[0] != self.n_original_channels:
+                    raise ValueError("Transforms marked `per_channel` must preserve the number of channels")
+                self.output_shape = (self.n_channels, *dummy_output.shape[1:])
+            else:
+                dummy_data = np.ones((self.n_channels, dummy_duration), dtype=np.float32)
+                dummy_output, self.final_sample_rate_hz = transform(dummy_data, self.original_sample_rate_hz)
+                self.output_shape = dummy_output.shape
         else:
             self.final_sample_rate_hz = self.original_sample_rate_hz
             self.output_shape = (self.n_channels, int(self.trial_duration_ms / 1000 * self.final_sample_rate_hz))
@@ -75,7 +95,9 @@ class THU_RSVP_Dataset:
         Fetch trial data from THU RSVP Dataset.
 
         Returns:
+            NOTE - data and labels are copy-on-write memory maps of the saved files.
             data (np.ndarray): shape (n_trials, n_channels, trial_duration_samples)
+                or (n_channels, n_trials, trial_duration_samples) if `channel_first` is set.
                 NOTE - the shape of returned data depends on the transformation function used.
                 For example - downsampling will reduce the duration of each trial, and time-frequency
                 transformations may add an extra dimension.
@@ -98,32 +120,54 @@ class THU_RSVP_Dataset:
         if self.download:
             self.dir.mkdir(exist_ok=True, parents=True)
 
-        for basename, md5_hash in tqdm(ALL_FILES_AND_SHA256SUMS, desc="Download + Verify Files", leave=True):
+        # Check existing files concurrently; hashing releases the GIL
+        with ThreadPoolExecutor(max_workers=min(8, len(ALL_FILES_AND_SHA256SUMS))) as pool:
+            already_verified = list(
+                pool.map(
+                    lambda item: verify_file(self.dir / item[0], item[1], verify_sha256=self.verify_sha256),
+                    ALL_FILES_AND_SHA256SUMS,
+                )
+            )
+
+        for (basename, md5_hash), verified in tqdm(
+            zip(ALL_FILES_AND_SHA256SUMS, already_verified),
+            desc="Download + Verify Files",
+            total=len(ALL_FILES_AND_SHA256SUMS),
+            leave=True,
+        ):
             output_path = self.dir / basename
-            if verify_file(output_path, md5_hash, verify_sha256=self.verify_sha256):
+            if verified:
                 if self.verbose:
                     logger.info(f"Already have {str(output_path)}, verified checksum: {self.verify_sha256} ")
                 continue
 
-            if self.download:  # Download if necessary
-                download_url(SOURCE_URL + "/" + basename, output_path)
-
-            if not verify_file(output_path, md5_hash, self.verify_sha256):  # Verify download
+            if not self.download:
                 raise ValueError(f"md5sum mismatch for: {basename}")
 
+            # Download if necessary. Checksum is verified while writing, so the file is not read again
+            download_url(
+                SOURCE_URL + "/" + basename, output_path, expected_sha256=md5_hash if self.verify_sha256 else None
+            )
+
     def _decompress(self, force=False) -> None:
-        for zip_file, _ in tqdm(ZIP_FILES_AND_SHA256SUMS, desc="Decompress", leave=True):
+        def extract_one(zip_file: str) -> None:
             inpath = self.dir / zip_file
             outpath = self.dir / zip_file[:-4]  # Remove ".zip"
 
             if not force and outpath.exists():
                 if self.verbose:
                     logger.info(f"Skipping {str(outpath)}")
-                continue
-            else:
-                if self.verbose:
-                    logger.info(f"Decompressing {inpath} to {outpath}")
-                subprocess.run(f"unzip -o -q {str(inpath)} -d {str(outpath)}", shell=True, check=True)
+                return
+            if self.verbose:
+                logger.info(f"Decompressing {inpath} to {outpath}")
+            with ZipFile(inpath) as z:
+                z.extractall(outpath)
+
+        # Decompress all zip files concurrently; zlib releases the GIL
+        zip_files = [zip_file for zip_file, _ in ZIP_FILES_AND_SHA256SUMS]
+        with ThreadPoolExecutor(max_workers=len(zip_files)) as pool:
+            for _ in tqdm(pool.map(extract_one, zip_files), desc="Decompress", total=len(zip_files), leave=True):
+                pass
 
     def _extract_trials(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
         """
@@ -161,8 +205,9 @@ class THU_RSVP_Dataset:
             9304 - 6829 = 2475 samples long to cover 99 intervals of 100ms
             2475 samples / (99 * 0.1 s) = 250 Hz
         """
-        trial_data_path = self.dir / f"trial_data.{self.trial_duration_ms}ms.npy"
-        trial_data_sha256_path = self.dir / f"trial_data.{self.trial_duration_ms}ms.sha256"
+        layout = ".channel_first" if self.channel_first else ""
+        trial_data_path = self.dir / f"trial_data.{self.trial_duration_ms}ms{layout}.npy"
+        trial_data_sha256_path = self.dir / f"trial_data.{self.trial_duration_ms}ms{layout}.sha256"
 
         subj_id_path = self.dir / f"subj_id.{self.trial_duration_ms}ms.npy"
         subj_id_sha256_path = self.dir / f"subj_id.{self.trial_duration_ms}ms.sha256"
@@ -201,7 +246,12 @@ class THU_RSVP_Dataset:
         if not self.force_extract and can_reuse():  # Try to use pre-existing files if possible
             if self.verbose:
                 logger.info(f"Loading previously extracted data and labels. verified checksum: {self.verify_sha256}.")
-            return np.load(trial_data_path), np.load(trial_labels_path), np.load(subj_id_path), np.load(sess_id_path)
+            return (
+                np.load(trial_data_path, mmap_mode="c"),
+                np.load(trial_labels_path, mmap_mode="c"),
+                np.load(subj_id_path),
+                np.load(sess_id_path),
+            )
 
         # list of (filepath, subj_id, sess_id)
         mat_files_subj_sess = [
@@ -209,43 +259,92 @@ class THU_RSVP_Dataset:
             for subj_idx in range(1, 65)
             for sess_id, session in [(0, "A"), (1, "B")]
         ]
+        # Each session occupies a fixed range of trials in the output, starting at this cursor
+        mat_files_cursors = [
+            (mat_file, i * self.n_trials_per_session) for i, (mat_file, _, _) in enumerate(mat_files_subj_sess)
+        ]
 
-        # Assign trials and labels directly into arrays to avoid memory overhead.
-        data = np.empty(shape=(self.n_trials, *self.output_shape), dtype=np.float32)
-        labels = np.empty(shape=(self.n_trials,), dtype=int)
-        subj_id = np.empty(shape=(self.n_trials,), dtype=int)
-        sess_id = np.empty(shape=(self.n_trials,), dtype=int)
-
-        n_processes = int(multiprocessing.cpu_count() / 2 * 3)  # All processes reading *.mat files - probably IO bound
-        with Pool(n_processes) as pool:
-            worker_fn = partial(
-                load_trials_one_session,
-                channels_to_use=self.channels_to_use,
-                original_sample_rate_hz=self.original_sample_rate_hz,
-                trial_duration_samples=self.trial_duration_samples,
-                transform=self.transform,
-            )
-            cursor = 0
-            for one_data, one_labels, one_subj_id, one_sess_id in tqdm(
-                # use imap to get partial results as they become available (trying to avoid memory overhead)
-                pool.imap(worker_fn, mat_files_subj_sess, chunksize=1),
-                desc="Extract Trials",
-                total=len(mat_files_subj_sess),
-                leave=True,
-            ):
-                data[cursor : cursor + len(one_data)] = one_data
-                labels[cursor : cursor + len(one_labels)] = one_labels
-                subj_id[cursor : cursor + len(one_subj_id)] = one_subj_id
-                sess_id[cursor : cursor + len(one_sess_id)] = one_sess_id
-                cursor += len(one_data)
-
-        # Save data and SHA256 checksum
+        # Previous results are about to be replaced, so remove their checksums first.
+        # This way an interrupted extraction never leaves behind files that look reusable.
+        for shasum in [trial_data_sha256_path, subj_id_sha256_path, sess_id_sha256_path, trial_labels_sha256_path]:
+            if shasum.exists():
+                shasum.unlink()
+
+        # Assign trials and labels directly into memory-mapped output files to avoid memory overhead.
+        # Workers open the trial data file and write their sessions in place.
+        # Both are written to temporary files, which only replace the final files once extraction succeeds.
+        tmp_trial_data_path = trial_data_path.with_name(trial_data_path.name + ".tmp")
+        tmp_trial_labels_path = trial_labels_path.with_name(trial_labels_path.name + ".tmp")
         if self.verbose:
             logger.info(f"Saving {trial_data_path}")
-        np.save(trial_data_path, data)
+        if self.channel_first:
+            data_shape = (self.output_shape[0], self.n_trials, *self.output_shape[1:])
+        else:
+            data_shape = (self.n_trials, *self.output_shape)
+        data = np.lib.format.open_memmap(tmp_trial_data_path, mode="w+", dtype=np.float32, shape=data_shape)
+        if self.verbose:
+            logger.info(f"Saving {trial_labels_path}")
+        labels = np.lib.format.open_memmap(tmp_trial_labels_path, mode="w+", dtype=np.int8, shape=(self.n_trials,))
+        subj_id = np.repeat([s for _, s, _ in mat_files_subj_sess], self.n_trials_per_session)
+        sess_id = np.repeat([s for _, _, s in mat_files_subj_sess], self.n_trials_per_session)
+
+        try:
+            # Each process prefetches its next files in a background thread, so IO overlaps with filtering.
+            # Small work units keep the processes balanced and the progress bar moving, while each unit
+            # is still long enough for the prefetch to fill.
+            n_processes = multiprocessing.cpu_count()
+            prefetch_factor = 2
+            sessions_per_unit = prefetch_factor + 1
+            with ProcessPoolExecutor(n_processes) as pool:
+                worker_fn = partial(
+                    load_trials_sessions,
+                    channels_to_use=self.channels_to_use,
+                    original_sample_rate_hz=self.original_sample_rate_hz,
+                    trial_duration_samples=self.trial_duration_samples,
+                    out_path=tmp_trial_data_path,
+                    channel_first=self.channel_first,
+                    transform=self.transform,
+                    prefetch_factor=prefetch_factor,
+                )
+                futures = [pool.submit(worker_fn, c) for c in chunks(mat_files_cursors, sessions_per_unit)]
+                cursor_files = {cursor: mat_file for mat_file, cursor in mat_files_cursors}
+                try:
+                    with tqdm(desc="Extract Trials", total=len(mat_files_cursors), leave=True) as pbar:
+                        for future in as_completed(futures):
+                            for cursor, n_written, one_labels in future.result():
+                                # Sessions are written into fixed ranges, so any other count would misalign them
+                                if n_written != self.n_trials_per_session:
+                                    raise ValueError(
+                                        f"Expected {self.n_trials_per_session} trials in {cursor_files[cursor]}, "
+                                        f"got {n_written}"
+                                    )
+                                labels[cursor : cursor + n_written] = one_labels
+                                pbar.update(1)
+                except BaseException:
+                    # Stop queued work units, otherwise the pool runs them all before the error is raised
+                    for f in futures:
+                        f.cancel()
+                    raise
+            data.flush()
+            labels.flush()
+        except BaseException:
+            # Do not leave large partial outputs behind
+            for tmp_path in [tmp_trial_data_path, tmp_trial_labels_path]:
+                if tmp_path.exists():
+                    tmp_path.unlink()
+            raise
+        del data, labels
+        os.replace(tmp_trial_data_path, trial_data_path)
+        os.replace(tmp_trial_labels_path, trial_labels_path)
+
+        # Return copy-on-write views, so that modifying the returned arrays does not alter the saved files.
+        # Previously extracted data is loaded the same way above.
+        data = np.load(trial_data_path, mmap_mode="c")
+        labels = np.load(trial_labels_path, mmap_mode="c")
+
         if self.verbose:
             logger.info(f"Saving {trial_data_sha256_path}")
-        trial_data_sha256_path.write_text(file_sha256hash(trial_data_path))
+        trial_data_sha256_path.write_text(cached_file_sha256hash(trial_data_path))
 
         # Save subj id and SHA256 checksum
         if self.verbose:
@@ -253,7 +352,7 @@ class THU_RSVP_Dataset:
         np.save(subj_id_path, subj_id)
         if self.verbose:
             logger.info(f"Saving {subj_id_sha256_path}")
-        subj_id_sha256_path.write_text(file_sha256hash(subj_id_path))
+        subj_id_sha256_path.write_text(cached_file_sha256hash(subj_id_path))
 
         # Save sess id and SHA256 checksum
         if self.verbose:
@@ -261,13 +360,10 @@ class THU_RSVP_Dataset:
         np.save(sess_id_path, sess_id)
         if self.verbose:
             logger.info(f"Saving {sess_id_sha256_path}")
-        sess_id_sha256_path.write_text(file_sha256hash(sess_id_path))
+        sess_id_sha256_path.write_text(cached_file_sha256hash(sess_id_path))
 
-        # Save labels and SHA256 checksum
-        if self.verbose:
-            logger.info(f"Saving {trial_labels_path}")
-        np.save(trial_labels_path, labels)
+        # Save labels SHA256 checksum
         if self.verbose:
             logger.info(f"Saving {trial_labels_sha256_path}")
-        trial_labels_sha256_path.write_text(file_sha256hash(trial_labels_path))
+        trial_labels_sha256_path.write_text(cached_file_sha256hash(trial_labels_path))
         return data, labels, subj_id, sess_id
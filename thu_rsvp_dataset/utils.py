@@ -1,15 +1,28 @@
+import contextlib
 import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
 from pathlib import Path
-from typing import Iterable
+from typing import Iterable, Optional
 
 import requests
 from tqdm import tqdm
 
 DEFAULT_CHUNKSIZE = 10 * 1024 * 1024
+SHA256_CACHE_FILENAME = ".sha256.cache.json"
+_sha256_cache_lock = threading.Lock()
 
 
-def download_url(url: str, output_filepath: Path) -> None:
+def download_url(url: str, output_filepath: Path, expected_sha256: Optional[str] = None) -> None:
+    """
+    Download a file, computing its SHA256 hash while writing so it does not need to be read again to verify.
+    If `expected_sha256` is given, raises ValueError on mismatch.
+    """
     basename = url.split("/")[-1]
+    sha256 = hashlib.sha256()
     with requests.get(url, stream=True) as r, open(output_filepath, "wb") as f:
         r.raise_for_status()
         total_size_in_bytes = int(r.headers.get("content-length", 0))
@@ -27,11 +40,21 @@ def download_url(url: str, output_filepath: Path) -> None:
         ) as pbar:
             for chunk in r.iter_content(chunk_size=chunk_size):
                 pbar.update(len(chunk))
+                sha256.update(chunk)
                 f.write(chunk)
 
+    sha256sum = sha256.hexdigest()
+    record_file_sha256hash(output_filepath, sha256sum)
+    if expected_sha256 is not None and sha256sum != expected_sha256:
+        raise ValueError(f"sha256sum mismatch for: {basename}")
+
 
 def file_sha256hash(filepath: Path, chunksize=DEFAULT_CHUNKSIZE) -> str:
     """Compute SHA256 hash for one file"""
+    if sys.version_info >= (3, 11):
+        # Reads and hashes in C, without a Python-level loop over chunks
+        with open(filepath, "rb") as f:
+            return hashlib.file_digest(f, "sha256").hexdigest()
     sha256 = hashlib.sha256()
     with open(filepath, "rb") as f:
         for chunk in iter(lambda: f.read(chunksize), b""):
@@ -39,12 +62,64 @@ def file_sha256hash(filepath: Path, chunksize=DEFAULT_CHUNKSIZE) -> str:
     return sha256.hexdigest()
 
 
+def _read_sha256_cache(cache_path: Path) -> dict:
+    try:
+        return json.loads(cache_path.read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def cached_file_sha256hash(filepath: Path, chunksize=DEFAULT_CHUNKSIZE) -> str:
+    """
+    Compute SHA256 hash for one file, reusing a previous result if the file's size and mtime are unchanged.
+    Results are stored in a JSON cache file in the same folder as the hashed file.
+    """
+    cache_path = filepath.parent / SHA256_CACHE_FILENAME
+    stat = filepath.stat()
+    key = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    with _sha256_cache_lock:
+        entry = _read_sha256_cache(cache_path).get(filepath.name)
+    if entry is not None and all(entry.get(k) == v for k, v in key.items()):
+        return entry["sha256"]
+
+    sha256sum = file_sha256hash(filepath, chunksize)
+    record_file_sha256hash(filepath, sha256sum)
+    return sha256sum
+
+
+def record_file_sha256hash(filepath: Path, sha256sum: str) -> None:
+    """
+    Store a known SHA256 hash for one file in the JSON cache used by `cached_file_sha256hash`.
+    Caching is best-effort: if the cache cannot be written, the hash is simply not stored.
+    """
+    cache_path = filepath.parent / SHA256_CACHE_FILENAME
+    stat = filepath.stat()
+    with _sha256_cache_lock:
+        # Re-read in case other entries were added meanwhile, then replace the cache file atomically.
+        # The temporary file name is unique, so other processes updating the same cache do not collide.
+        cache = _read_sha256_cache(cache_path)
+        cache[filepath.name] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha256sum}
+        tmp_path = None
+        try:
+            with tempfile.NamedTemporaryFile(
+                "w", dir=cache_path.parent, prefix=cache_path.name, suffix=".tmp", delete=False
+            ) as f:
+                tmp_path = f.name
+                json.dump(cache, f, indent=2)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            if tmp_path is not None:
+                with contextlib.suppress(OSError):
+                    os.remove(tmp_path)
+
+
 def verify_file(file: Path, sha256sum: str, verify_sha256=True, chunksize=DEFAULT_CHUNKSIZE) -> bool:
     if not file.exists():
         return False
     if not verify_sha256:
         return True
-    return file_sha256hash(file, chunksize) == sha256sum
+    return cached_file_sha256hash(file, chunksize) == sha256sum
 
 
 def folder_sha256sum(folder: Path, include_filenames=None, chunksize=DEFAULT_CHUNKSIZE) -> str:
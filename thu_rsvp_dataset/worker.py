@@ -1,51 +1,217 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Callable, Optional, Tuple
+from typing import Callable, Dict, List, Optional, Tuple
 
 import numpy as np
 from scipy.io import loadmat
 
+try:
+    from numba import njit
+except ImportError:  # numba is optional, fall back to numpy fancy indexing
+    njit = None
 
-def load_trials_one_session(
-    matfile_subj_sess: Tuple[Path, int, int],
+# Only these variables are used; skip parsing anything else stored in the session mat files
+MAT_VARIABLE_NAMES = ["EEGdata1", "EEGdata2", "trigger_positions", "class_labels"]
+
+
+def load_session_mat(mat_file: Path) -> Dict[str, np.ndarray]:
+    return loadmat(mat_file, variable_names=MAT_VARIABLE_NAMES)
+
+
+def load_trials_sessions(
+    matfiles_cursors: List[Tuple[Path, int]],
     channels_to_use: np.ndarray,
     original_sample_rate_hz: int,
     trial_duration_samples: int,
+    out_path: Path,
     transform: Optional[Callable] = None,
-):
+    prefetch_factor: int = 2,
+    channel_first: bool = False,
+) -> List[Tuple[int, int, np.ndarray]]:
     """
     Worker function for multiprocess data loading.
-    Each session is stored in a mat file. It consists of 2 blocks of 40 sequences.
-    """
-    mat_file, subj_id, sess_id = matfile_subj_sess
-    trial_data, trial_labels = [], []
-    contents = loadmat(mat_file)
-
-    # Remove channels with indices 32 and 42.
-    # E.g. try `np.arange(64)[np.r_[0:32,33:42,43:64]]`
-    data1 = contents["EEGdata1"][channels_to_use].astype(np.float32)
-    data2 = contents["EEGdata2"][channels_to_use].astype(np.float32)
-    if transform is not None:
-        data1, final_sample_rate_hz = transform(data1, original_sample_rate_hz)
-        data2, final_sample_rate_hz = transform(data2, original_sample_rate_hz)
+    Processes several sessions in order, while a background thread reads the next `prefetch_factor` mat files
+    so that file IO overlaps with filtering.
+    Trials are written in-place into the float32 `.npy` file at `out_path`, which must already exist.
+    Its layout is (n_trials, n_channels, ...), or (n_channels, n_trials, ...) if `channel_first`.
+    Returns one (cursor, number of trials written, labels) tuple per session.
+    """
+    results = []
+    out = np.load(out_path, mmap_mode="r+")
+    with ThreadPoolExecutor(max_workers=1) as io_pool:
+        pending = deque(io_pool.submit(load_session_mat, f) for f, _ in matfiles_cursors[:prefetch_factor])
+        for i, (_, cursor) in enumerate(matfiles_cursors):
+            contents = pending.popleft().result()
+            if i + prefetch_factor < len(matfiles_cursors):
+                pending.append(io_pool.submit(load_session_mat, matfiles_cursors[i + prefetch_factor][0]))
+            results.append(
+                load_trials_one_session(
+                    contents,
+                    cursor,
+                    channels_to_use,
+                    original_sample_rate_hz,
+                    trial_duration_samples,
+                    out,
+                    transform,
+                    channel_first,
+                )
+            )
+    out.flush()
+    return results
+
+
+def load_trials_one_session(
+    contents: Dict[str, np.ndarray],
+    cursor: int,
+    channels_to_use: np.ndarray,
+    original_sample_rate_hz: int,
+    trial_duration_samples: int,
+    out: np.ndarray,
+    transform: Optional[Callable] = None,
+    channel_first: bool = False,
+) -> Tuple[int, int, np.ndarray]:
+    """
+    Extract trials from the contents of one session's mat file.
+    Each session consists of 2 blocks of 40 sequences.
+
+    Trials are written in-place into `out`, starting at trial index `cursor`.
+    Returns (cursor, number of trials written, labels).
+    """
+    if transform is None or getattr(transform, "per_channel", False):
+        # Filter all channels from a single contiguous float32 copy. Unused channels (indices 32 and 42) are
+        # dropped while gathering trials, which avoids copying the session again.
+        block1, block2 = contents["EEGdata1"], contents["EEGdata2"]
+        gather_channels = channels_to_use
     else:
-        final_sample_rate_hz = original_sample_rate_hz
+        # Transform may mix channels, so remove unused channels before applying it.
+        # E.g. try `np.arange(64)[np.r_[0:32,33:42,43:64]]`
+        block1, block2 = contents["EEGdata1"][channels_to_use], contents["EEGdata2"][channels_to_use]
+        gather_channels = None
 
-    trial_onsets1 = contents["trigger_positions"][0]
-    trial_onsets2 = contents["trigger_positions"][1]
+    if transform is not None and getattr(transform, "supports_batching", False):
+        data1, data2, final_sample_rate_hz = transform_blocks_batched(
+            block1, block2, original_sample_rate_hz, transform
+        )
+    else:
+        data1 = block1.astype(np.float32, copy=False)
+        data2 = block2.astype(np.float32, copy=False)
+        if transform is not None:
+            data1, final_sample_rate_hz = transform(data1, original_sample_rate_hz)
+            data2, final_sample_rate_hz = transform(data2, original_sample_rate_hz)
+        else:
+            final_sample_rate_hz = original_sample_rate_hz
+    # No-op for the built-in filters, which keep float32 throughout
+    data1 = data1.astype(np.float32, copy=False)
+    data2 = data2.astype(np.float32, copy=False)
+    if gather_channels is None:
+        gather_channels = np.arange(data1.shape[0])
 
     # Originally, "1" == target, "2" == non-target.
     # Subtract 1 to convert from "1" and "2" to "0" == target and "1" == non-target.
-    labels1 = contents["class_labels"][0] - 1
-    labels2 = contents["class_labels"][1] - 1
+    labels1 = (contents["class_labels"][0] - 1).astype(np.int8)
+    labels2 = (contents["class_labels"][1] - 1).astype(np.int8)
 
-    # Hz * duration in s = duration in samples
+    # NOTE - after downsampling, need to convert sample indices. Convert onsets for both blocks at once,
+    # using integer division when the downsample factor is an integer.
     downsample_factor = original_sample_rate_hz / final_sample_rate_hz
-    for data, trial_onsets, labels in [(data1, trial_onsets1, labels1), (data2, trial_onsets2, labels2)]:
-        for i, trial_onset in enumerate(trial_onsets):
-            # NOTE - after downsampling, need to convert sample indices
-            converted_onset = int(trial_onset // downsample_factor)
-            trial_data.append(data[..., converted_onset : converted_onset + trial_duration_samples])
-            trial_labels.append(labels[i])
-    subj_id = subj_id * np.ones_like(trial_labels)
-    sess_id = sess_id * np.ones_like(trial_labels)
-    return trial_data, trial_labels, subj_id, sess_id
+    if downsample_factor.is_integer():
+        trial_onsets = contents["trigger_positions"].astype(np.intp) // int(downsample_factor)
+    else:
+        trial_onsets = (contents["trigger_positions"] // downsample_factor).astype(np.intp)
+
+    n_written = 0
+    for data, onsets in [(data1, trial_onsets[0]), (data2, trial_onsets[1])]:
+        start = cursor + n_written
+        if channel_first:
+            out_block = out[:, start : start + len(onsets)]
+        else:
+            out_block = out[start : start + len(onsets)]
+        gather_trials(data, gather_channels, onsets, trial_duration_samples, out_block, channel_first)
+        n_written += len(onsets)
+    return cursor, n_written, np.concatenate([labels1, labels2])
+
+
+def transform_blocks_batched(
+    block1: np.ndarray, block2: np.ndarray, original_sample_rate_hz: int, transform: Callable
+) -> Tuple[np.ndarray, np.ndarray, int]:
+    """
+    Apply a transform to both blocks of a session with a single call.
+    Blocks are stacked into one float32 array of shape (2, n_channels, T), with the shorter block zero-padded at the
+    end. This is only valid for transforms with `supports_batching`, whose output does not depend on trailing samples.
+    """
+    lengths = [block1.shape[-1], block2.shape[-1]]
+    batch = np.zeros((2, block1.shape[0], max(lengths)), dtype=np.float32)
+    batch[0, :, : lengths[0]] = block1
+    batch[1, :, : lengths[1]] = block2
+    batch, final_sample_rate_hz = transform(batch, original_sample_rate_hz)
+
+    # Trim the padding back off, after converting lengths to the new sample rate
+    downsample_factor = original_sample_rate_hz / final_sample_rate_hz
+    data1, data2 = [batch[i, ..., : int(np.ceil(n / downsample_factor))] for i, n in enumerate(lengths)]
+    return data1, data2, final_sample_rate_hz
+
+
+def gather_trials(
+    data: np.ndarray,
+    channels: np.ndarray,
+    onsets: np.ndarray,
+    trial_duration_samples: int,
+    out: np.ndarray,
+    channel_first: bool = False,
+) -> None:
+    """
+    Gather all trials of one block into `out`, keeping only the selected channels.
+    Writes shape (n_trials, n_channels, ..., T), or (n_channels, n_trials, ..., T) if `channel_first`,
+    from data of shape (n_all_channels, ..., T_block).
+    """
+    if _gather_trials_2d is not None and data.ndim == 2:
+        # Numba does not bounds check reads or writes, so validate here to match numpy's IndexError
+        if len(onsets) and (onsets.min() < 0 or onsets.max() + trial_duration_samples > data.shape[-1]):
+            raise IndexError("Trial extends beyond the end of the recorded data")
+        if len(channels) and (channels.min() < 0 or channels.max() >= data.shape[0]):
+            raise IndexError(f"Channel index out of bounds for data with {data.shape[0]} channels")
+        if channel_first:
+            expected_shape = (len(channels), len(onsets), trial_duration_samples)
+        else:
+            expected_shape = (len(onsets), len(channels), trial_duration_samples)
+        if out.shape != expected_shape:
+            raise ValueError(f"Output has shape {out.shape}, expected {expected_shape}")
+        if channel_first:
+            _gather_trials_2d_channel_first(data, channels, onsets, trial_duration_samples, out)
+        else:
+            _gather_trials_2d(data, channels, onsets, trial_duration_samples, out)
+        return
+
+    idx = onsets[:, None] + np.arange(trial_duration_samples)
+    if data.ndim == 2:
+        # Select channels and trials with a single fancy index: (n_channels, n_trials, T)
+        trials = data[channels[:, None, None], idx]
+    else:
+        trials = data[channels][..., idx]
+    out[...] = np.moveaxis(trials, -2, 1 if channel_first else 0)
+
+
+if njit is not None:
+
+    @njit(cache=True)
+    def _gather_trials_2d(data, channels, onsets, trial_duration_samples, out):
+        # Write each output trial contiguously, reading one channel row at a time
+        for k in range(len(onsets)):
+            for c in range(len(channels)):
+                row = channels[c]
+                for t in range(trial_duration_samples):
+                    out[k, c, t] = data[row, onsets[k] + t]
+
+    @njit(cache=True)
+    def _gather_trials_2d_channel_first(data, channels, onsets, trial_duration_samples, out):
+        # Read each channel row once, writing its trials contiguously
+        for c in range(len(channels)):
+            row = channels[c]
+            for k in range(len(onsets)):
+                for t in range(trial_duration_samples):
+                    out[c, k, t] = data[row, onsets[k] + t]
+
+else:
+    _gather_trials_2d = None
+    _gather_trials_2d_channel_first = None